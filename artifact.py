@@ -1,34 +1,49 @@
+import re
+
+_CODE_BLOCK_RE = re.compile(r'```(\w*)\n(.*?)\n```', re.DOTALL)
+_ARTIFACT_TMPL = '<antArtifact identifier="{id}" type="{type}" language="{lang}" title="Code Block">{content}</antArtifact>'
+
 class ArtifactHandler:
     """Handles conversion between Claude artifacts and Slack blocks"""
     
+    # Content is matched as an unrolled loop that stops at the next opening or
+    # closing antArtifact tag. An unterminated opener therefore fails at the next
+    # opener instead of rescanning the rest of the text, so the total work stays
+    # linear in the input. Content cannot contain a nested <antArtifact> tag.
+    # Nothing else may match whitespace next to the content, or the engine retries
+    # every split of it; surrounding whitespace is stripped in parse_artifacts.
     ARTIFACT_PATTERN = re.compile(
-        r'<antArtifact\s+identifier="([^"]+)"\s+type="([^"]+)"\s+(?:language="([^"]+)")?\s*title="([^"]+)">\s*(.*?)\s*</antArtifact>',
-        re.DOTALL
+        r'<antArtifact\s+identifier="([^"]+)"\s+type="([^"]+)"(?:\s+language="([^"]+)")?\s+title="([^"]+)">([^<]*(?:<(?!/?antArtifact[\s>])[^<]*)*)</antArtifact>'
     )
     
+    # artifact type -> (code fence language, is raw markdown)
+    # "__lang__" uses the artifact's own language attribute
+    _TYPE_TABLE = {
+        "application/vnd.ant.code": ("__lang__", False),
+        "text/markdown": (None, True),
+        "text/html": ("html", False),
+        "application/vnd.ant.react": ("html", False),
+        "image/svg+xml": ("xml", False),
+        "application/vnd.ant.mermaid": ("mermaid", False),
+    }
+    
     @staticmethod
     def parse_artifacts(text):
         """Extract artifacts from Claude's response text"""
         artifacts = []
-        cleaned_text = text
-        
-        for match in ArtifactHandler.ARTIFACT_PATTERN.finditer(text):
-            identifier = match.group(1)
-            type = match.group(2)
-            language = match.group(3)
-            title = match.group(4)
-            content = match.group(5)
-            
+
+        def _collect(match):
             artifacts.append({
-                "identifier": identifier,
-                "type": type,
-                "language": language,
-                "title": title,
-                "content": content
+                "identifier": match.group(1),
+                "type": match.group(2),
+                "language": match.group(3),
+                "title": match.group(4),
+                "content": match.group(5).strip()
             })
-            
             # Remove the artifact tag from cleaned text
-            cleaned_text = cleaned_text.replace(match.group(0), "")
+            return ""
+
+        cleaned_text = ArtifactHandler.ARTIFACT_PATTERN.sub(_collect, text)
             
         return cleaned_text.strip(), artifacts
 
@@ -52,75 +67,44 @@ class ArtifactHandler:
 
     @staticmethod
     def artifact_to_blocks(artifact):
-        """Convert a single artifact to Slack blocks"""
-        blocks = []
-        
+        """Yield Slack blocks for a single artifact"""
         # Add title divider
-        blocks.append({
+        yield {
             "type": "divider"
-        })
-        blocks.append({
+        }
+        yield {
             "type": "section",
             "text": {
                 "type": "mrkdwn",
                 "text": f"*{artifact['title']}*"
             }
-        })
+        }
         
         content = artifact['content']
         artifact_type = artifact['type']
         
-        if artifact_type == "application/vnd.ant.code":
-            # Code artifacts
-            blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": f"```{artifact['language'] or ''}\n{content}\n```"
-                }
-            })
-            
-        elif artifact_type == "text/markdown":
+        lang, is_markdown = ArtifactHandler._TYPE_TABLE.get(artifact_type, (None, False))
+        if is_markdown:
             # Markdown artifacts
-            blocks.append({
+            yield {
                 "type": "section",
                 "text": {
                     "type": "mrkdwn",
                     "text": content
                 }
-            })
-            
-        elif artifact_type in ["text/html", "application/vnd.ant.react"]:
-            # HTML and React artifacts as code blocks
-            blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": f"```html\n{content}\n```"
-                }
-            })
-            
-        elif artifact_type == "image/svg+xml":
-            # SVG artifacts as code blocks
-            blocks.append({
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": f"```xml\n{content}\n```"
-                }
-            })
+            }
             
-        elif artifact_type == "application/vnd.ant.mermaid":
-            # Mermaid diagrams as code blocks
-            blocks.append({
+        elif lang is not None:
+            # Everything else is shown as a code block
+            if lang == "__lang__":
+                lang = artifact['language'] or ''
+            yield {
                 "type": "section",
                 "text": {
                     "type": "mrkdwn",
-                    "text": f"```mermaid\n{content}\n```"
+                    "text": f"```{lang}\n{content}\n```"
                 }
-            })
-            
-        return blocks
+            }
 
     @staticmethod
     def reconstruct_artifacts(blocks):
@@ -133,7 +117,7 @@ class ArtifactHandler:
                 text = block["text"]["text"]
                 
                 # Check if this is a code block
-                code_match = re.match(r'```(\w*)\n(.*?)\n```', text, re.DOTALL)
+                code_match = _CODE_BLOCK_RE.match(text)
                 if code_match:
                     language = code_match.group(1)
                     content = code_match.group(2)
@@ -150,11 +134,9 @@ class ArtifactHandler:
                     
                     # Create artifact tag
                     if current_artifact:
-                        messages.append(
-                            f'<antArtifact identifier="{current_artifact}" '
-                            f'type="{type}" language="{language}" '
-                            f'title="Code Block">{content}</antArtifact>'
-                        )
+                        messages.append(_ARTIFACT_TMPL.format(
+                            id=current_artifact, type=type, lang=language, content=content
+                        ))
                         current_artifact = None
                 else:
                     # Regular text
@@ -3,22 +3,66 @@ import logging
 import re
 import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from anthropic import Anthropic
 import json
-import copy
 import ast
+import hashlib
+import functools
+import bisect
 from diskcache import Cache
 import traceback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 cache = Cache(os.environ.get("AICAFE_CACHE_DIR", "/tmp/ai-cafe-cache"))
 LONGRESPONSE = "Response was too long for Slack. See attached llm_response.txt"
+# Pooled keepalive session for Slack file downloads
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                       max_retries=Retry(total=3, backoff_factor=0.2)))
+# Attachment fetches are network bound, run them side by side
+_io_pool = ThreadPoolExecutor(max_workers=8)
+# Config block in double braces at start of message
+_CONFIG_RE = re.compile(r'^\s*{{(.+?)}}\s*(.*)', re.DOTALL)
+
+def _dump_json(obj):
+    """Pretty-print obj as JSON for logs, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
+
+@functools.lru_cache(maxsize=256)
+def _parse_config_str(config_str):
+    """Parse the inside of a config block, trying JSON before Python literal syntax.
+    The result is shared between callers and must not be mutated."""
+    try:
+        return json.loads('{' + config_str + '}')
+    except json.JSONDecodeError:
+        return ast.literal_eval('{' + config_str + '}')
+
+def _startswith_stripped(text, prefix, ignore_case=False):
+    """Same as text.strip().startswith(prefix), without copying the whole text.
+    With ignore_case, prefix must be lowercase."""
+    i = 0
+    n = len(text)
+    while i < n and text[i].isspace():
+        i += 1
+    if ignore_case:
+        return text[i:i + len(prefix)].lower() == prefix
+    return text.startswith(prefix, i)
 
 class AttachmentHandler:
     """Handles file attachments in messages"""
@@ -38,20 +82,33 @@ class AttachmentHandler:
             else:
                 url = file_info["url_private"]
 
-            if url in cache:
-                logger.info(f"Using cached file: {url}")
+            is_binary = is_image or mimetype == "application/pdf"
+            encoded_key = f"b64:{file_info['id']}:{mimetype}"
+            encoded = cache.get(encoded_key) if is_binary else None
+
+            if encoded is not None:
+                logger.info("Using cached encoding: %s", url)
+            elif url in cache:
+                logger.info("Using cached file: %s", url)
                 content = cache[url]
             else:
-                logger.info(f"Downloading file: {url}")
-                response = requests.get(url, headers=headers)
-                response.raise_for_status()
-                content = response.content
-                cache[url] = content
+                logger.info("Downloading file: %s", url)
+                with _session.get(url, headers=headers, stream=True, timeout=(3.05, 30)) as response:
+                    response.raise_for_status()
+                    buf = BytesIO()
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        buf.write(chunk)
+                content = buf.getvalue()
+                # Binary files are cached in their base64 form below, not as raw bytes
+                if not is_binary:
+                    cache[url] = content
             
             
-            if is_image or mimetype == "application/pdf":
+            if is_binary:
                 # Convert image to base64
-                encoded = base64.b64encode(content).decode('utf-8')
+                if encoded is None:
+                    encoded = base64.b64encode(content).decode('ascii')
+                    cache.set(encoded_key, encoded)
                 return {
                     "type": "image" if is_image else "document",
                     "source": {
@@ -88,42 +145,60 @@ class AttachmentHandler:
         if not files:
             return []
         
+        # Fetch files concurrently, keeping results in attachment order
+        futures = [_io_pool.submit(AttachmentHandler._process_one, client, file) for file in files]
         file_contents = []
-        for file in files:
-            try:
-                # Get detailed file info
-                response = client.files_info(file=file["id"])
-                file_info = response["file"]
-                
-                processed = AttachmentHandler.download_and_encode_file(client, file_info)
-                if processed:
-                    file_contents.append(processed)
-                
-            except Exception as e:
-                logger.error(f"Error processing attachment: {e}")
+        for future in futures:
+            processed = future.result()
+            if processed:
+                file_contents.append(processed)
                 
         return file_contents
 
+    @staticmethod
+    def _process_one(client, file):
+        """Fetch file info and download a single attachment"""
+        try:
+            # Get detailed file info, which is immutable once uploaded
+            key = f"files_info:{file['id']}"
+            file_info = cache.get(key)
+            if file_info is None:
+                response = client.files_info(file=file["id"])
+                file_info = response["file"]
+                cache.set(key, file_info, expire=7*86400)
+            
+            return AttachmentHandler.download_and_encode_file(client, file_info)
+            
+        except Exception as e:
+            logger.error(f"Error processing attachment: {e}")
+            return None
+
 class ClaudeBot:
     def __init__(self, slack_token, app_token, anthropic_key, system_prompt):
         """Initialize the Claude bot with necessary tokens and clients"""
-        self.app = App(token=slack_token)
-        system_prompt = system_prompt.replace("{{currentDateTime}}", datetime.now().strftime("%A, %B %d, %Y"))
-        self.system_prompt = [
-            {
-                "type": "text",
-                "text": system_prompt
-            }
-        ] if system_prompt else ""
+        # Bolt acks events and runs handle_message on this pool. Each run may wait
+        # tens of seconds on Claude, so allow more in flight than Bolt's default of 5.
+        self._listener_pool = ThreadPoolExecutor(max_workers=16)
+        self.app = App(token=slack_token, listener_executor=self._listener_pool)
+        self._system_prompt_template = system_prompt
+        self._sysprompt_date_str = None
+        self._last_date_refresh = 0
+        self.refresh_system_prompt()
 
         self.anthropic = Anthropic(api_key=anthropic_key,
             default_headers={"anthropic-version": "2023-06-01", "anthropic-beta": "pdfs-2024-09-25,prompt-caching-2024-07-31"})
         
-        # Get bot's own ID during initialization
+        # Get bot's own ID during initialization, cached per token across restarts
         try:
-            auth_response = self.app.client.auth_test()
-            self.bot_user_id = auth_response["user_id"]
+            key = "bot_user_id:" + hashlib.sha256(slack_token.encode()).hexdigest()
+            self.bot_user_id = cache.get(key)
+            if self.bot_user_id is None:
+                auth_response = self.app.client.auth_test()
+                self.bot_user_id = auth_response["user_id"]
+                cache.set(key, self.bot_user_id, expire=86400)
             logger.info(f"Bot initialized with ID: {self.bot_user_id}")
+            self._mention_prefix = f"<@{self.bot_user_id}>"
+            self._prefix_re = re.compile(rf'\s*(<@{re.escape(self.bot_user_id)}>|@public)')
         except Exception as e:
             logger.error(f"Failed to get bot ID: {e}")
             raise
@@ -133,19 +208,39 @@ class ClaudeBot:
         
         # Initialize SocketModeHandler
         self.handler = SocketModeHandler(self.app, app_token)
-        self.last_api_call = datetime.now() - timedelta(minutes=10)
+        self.last_api_call = time.monotonic() - 600
+
+    def refresh_system_prompt(self):
+        """Substitute the current date into the system prompt, re-checking at most hourly"""
+        now = time.time()
+        if now - self._last_date_refresh <= 3600:
+            return
+        self._last_date_refresh = now
+        date_str = datetime.now().strftime("%A, %B %d, %Y")
+        if date_str == self._sysprompt_date_str:
+            return
+        self._sysprompt_date_str = date_str
+        system_prompt = self._system_prompt_template.replace("{{currentDateTime}}", date_str)
+        self.system_prompt = [
+            {
+                "type": "text",
+                "text": system_prompt
+            }
+        ] if system_prompt else ""
 
     def is_bot_mention(self, text):
         """Check if message starts with @claude-bot"""
-        return text.strip().startswith(f"<@{self.bot_user_id}>")
+        return _startswith_stripped(text, self._mention_prefix)
                                        
     def is_aside(self, text):
         """Check if message starts with @aside"""
-        return text.strip().lower().startswith("@aside")
+        return _startswith_stripped(text, "@aside", ignore_case=True)
     
     def log_event(self, event):
         """Log event details, but don't overwhelm. Event type, user, ts, type, subtype"""
 
+        if not logger.isEnabledFor(logging.INFO):
+            return
         logger.info(f"Event: subtype: {event.get('subtype')}, user: {event.get('user', event.get('message', {}).get('user'))}, ts: {event.get('ts')}")
     
         
@@ -171,7 +266,7 @@ class ClaudeBot:
 
             is_thread_message = "thread_ts" in msg
             text = msg.get("text", "")
-            logger.info(f"Got message: {text}")
+            logger.info("Got message: %s", text)
             # Handle new thread creation
             if not is_thread_message:
                 text, config = self.parse_config_block(text)
@@ -203,7 +298,7 @@ class ClaudeBot:
                     return
                 
                 first_msg["text"] = first_msg_txt
-                formatted_messages = self.format_thread(thread, client, config)
+                formatted_messages = self.format_thread(thread, client, config, event["channel"])
                 # if the last message was from the assistant, don't go further, we probably got a message_changed event
                 if formatted_messages[-1]["role"] == "assistant":
                     return
@@ -226,7 +321,7 @@ class ClaudeBot:
                 messages=msgs,
                 temperature=config.get("temperature", 0.7)
             )
-            self.last_api_call = datetime.now()
+            self.last_api_call = time.monotonic()
 
             self.remove_typing(client, event["channel"], msg["ts"])
 
@@ -235,8 +330,9 @@ class ClaudeBot:
             response_text = response.content[0].text
 
             cleaned_text, file = handle_large_response(response_text, client, event["channel"], thread_ts)
-            logger.info(f"usage: {response.usage}")
-            logger.info(f"response: {cleaned_text[:200]}")
+            logger.info("usage: %s", response.usage)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("response: %s", cleaned_text[:200])
             if file:
                 return # we uploaded a file, no need to post text
             blocks = convert_to_blocks(cleaned_text)
@@ -269,31 +365,29 @@ class ClaudeBot:
         """
 
         config = {}        
-        # Define the possible prefix patterns
-        bot_mention = f"<@{self.bot_user_id}>"
-        public_flag = "@public"
-        
-        # Check for and remove prefixes
+        # Check for and remove bot mention / @public prefixes, in any order
+        pos = 0
         while True:
-            text = text.strip()
-            if text.startswith(bot_mention):
-                config["is_bot_mention"] = True
-                text = text[len(bot_mention):].strip()
-            elif text.startswith(public_flag):
+            prefix = self._prefix_re.match(text, pos)
+            if not prefix:
+                break
+            if prefix.group(1) == "@public":
                 config["is_public"] = True
-                text = text[len(public_flag):].strip()
             else:
-                break
+                config["is_bot_mention"] = True
+            pos = prefix.end()
         
-        # Match text within double braces at start of string
-        pattern = r'^\s*{{(.+?)}}\s*(.*)'
-        match = re.match(pattern, text, re.DOTALL)
+        # Match text within double braces at start of string; most messages have none
+        text = text[pos:].lstrip()
+        if not text.startswith("{{"):
+            return text.rstrip(), config
+        match = _CONFIG_RE.match(text)
         if not match:
             return text.strip(), config
 
         try:
             config_str, remaining_text = match.groups()
-            config2 = ast.literal_eval('{' + config_str + '}')
+            config2 = _parse_config_str(config_str)
             
             if not isinstance(config, dict):
                 logger.error(f"Config block {config} must evaluate to a dictionary")
@@ -305,7 +399,7 @@ class ClaudeBot:
             logger.error(f"Invalid config block: {e}")
             return text.strip(), config
         
-    def format_thread(self, thread, client, config):
+    def format_thread(self, thread, client, config, channel):
         """Format thread messages for Claude API"""
         formatted_messages = []
         first_msg = thread["messages"][0]
@@ -321,35 +415,58 @@ class ClaudeBot:
             if self.is_aside(msg.get("text", "")):
                 continue
             
-            formatted_content = []
-            
-            # Handle bot messages with blocks (artifacts)
-            if user == self.bot_user_id and msg.get("blocks"):
-                blocktxt = reconstruct_from_slackmsg(msg["blocks"])
-                if blocktxt:
-                    msg["text"] = blocktxt
-            
-            # Add main message text
-            if msg.get("text") and not msg["text"].startswith(LONGRESPONSE):
-                formatted_content.append({
-                    "type": "text",
-                    "text": msg["text"]
-                })
-            
-            # Process attachments
+            # Text-only messages are memoized; bot messages are never edited, so ts alone identifies them.
+            # Messages with attachments are not, their files_info and base64 are already cached.
             if msg.get("files"):
-                file_contents = AttachmentHandler.process_attachments(client, msg["files"])
-                formatted_content.extend(file_contents)
+                formatted = self._format_msg(msg, client)
+            else:
+                if user == self.bot_user_id:
+                    key = f"fmsg:{channel}:{msg['ts']}"
+                else:
+                    key = f"fmsg:{channel}:{msg['ts']}:{msg.get('edited', {}).get('ts', '0')}"
+                formatted = cache.get(key)
+                if formatted is None:
+                    formatted = self._format_msg(msg, client)
+                    if formatted is not None:
+                        cache.set(key, formatted, expire=7*86400)
             
-            if len(formatted_content) == 0:
-                #print("No content", json.dumps(msg, indent=4))
+            if formatted is None:
                 continue
 
-            formatted_messages.append({
-                "role": "assistant" if user == self.bot_user_id else "user",
-                "content": formatted_content
-            })
+            formatted_messages.append(formatted)
         return formatted_messages
+
+    def _format_msg(self, msg, client):
+        """Format a single message for Claude API, None if it has no content"""
+        user = msg.get("user")
+        formatted_content = []
+        
+        # Handle bot messages with blocks (artifacts)
+        if user == self.bot_user_id and msg.get("blocks"):
+            blocktxt = reconstruct_from_slackmsg(msg["blocks"])
+            if blocktxt:
+                msg["text"] = blocktxt
+        
+        # Add main message text
+        if msg.get("text") and not msg["text"].startswith(LONGRESPONSE):
+            formatted_content.append({
+                "type": "text",
+                "text": msg["text"]
+            })
+        
+        # Process attachments
+        if msg.get("files"):
+            file_contents = AttachmentHandler.process_attachments(client, msg["files"])
+            formatted_content.extend(file_contents)
+        
+        if len(formatted_content) == 0:
+            #print("No content", json.dumps(msg, indent=4))
+            return None
+
+        return {
+            "role": "assistant" if user == self.bot_user_id else "user",
+            "content": formatted_content
+        }
     
     def handle_message_deleted(self, event, say, client):
         """Handle message deletions and cascade delete bot responses"""
@@ -367,14 +484,12 @@ class ClaudeBot:
                 ts=thread_ts
             )["messages"]
 
-            # Find deleted message index
+            # Find deleted message index; replies are ordered by ts
             deleted_ts = float(event["previous_message"]["ts"])
-            after_deleted_idx = next(
-                (i for i, msg in enumerate(messages) if float(msg["ts"]) >= deleted_ts),
-                -1
-            )
+            ts_list = [float(msg["ts"]) for msg in messages]
+            after_deleted_idx = bisect.bisect_left(ts_list, deleted_ts)
 
-            if after_deleted_idx == -1:
+            if after_deleted_idx == len(messages):
                 return
             
             # Delete all subsequent bot messages (only our bot's messages)
@@ -395,30 +510,43 @@ class ClaudeBot:
         """Apply cache headers to system prompt and first message with attachment if caching is enabled"""
 
         # Add cache control to system prompt if one exists
-        system_prompt = copy.deepcopy(self.system_prompt)
+        self.refresh_system_prompt()
+        system_prompt = self.system_prompt
         if system_prompt and isinstance(system_prompt, list):
-            system_prompt[-1]["cache_control"] = {"type": "ephemeral"}
+            system_prompt = system_prompt[:-1] + [{**system_prompt[-1], "cache_control": {"type": "ephemeral"}}]
         
-        # Find last message with an attachment and add cache to its last content element
-        for message in reversed(messages):
+        # Find last message with an attachment and add cache to its last content element.
+        # Only the touched message and content element are copied, attachments are shared.
+        messages = list(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            message = messages[i]
             if message["role"] == "user" and len(message["content"]) > 1:
-                message["content"][-1]["cache_control"] = {"type": "ephemeral"}
+                content = message["content"]
+                messages[i] = {
+                    **message,
+                    "content": content[:-1] + [{**content[-1], "cache_control": {"type": "ephemeral"}}]
+                }
                 break
         
         return messages, system_prompt
     
     def dump_claude_request(self, messages):
         """Dump Claude request for debugging"""
+        if not logger.isEnabledFor(logging.INFO):
+            return
         # print request, except long messages like attachments which should be trimmed to 1k characters
         # images and pdfs should be trimmed completely
-        messages_copy = copy.deepcopy(messages)
-        for message in messages_copy:
+        messages_copy = []
+        for message in messages:
+            contents = []
             for content in message.get("content", []):
                 if content.get("type") == "image" or content.get("type") == "document":
-                    content["source"]["data"] = ""
+                    content = {**content, "source": {**content["source"], "data": ""}}
                 elif content.get("type") == "text":
-                    content["text"] = content["text"][:200]
-        logger.info(f"Claude Request: {json.dumps(messages_copy, indent=4)}")
+                    content = {**content, "text": content["text"][:200]}
+                contents.append(content)
+            messages_copy.append({**message, "content": contents})
+        logger.info("Claude Request: %s", _dump_json(messages_copy))
 
     def show_typing(self, client, channel, ts):
         """Show typing indicator in the channel"""
@@ -469,7 +597,8 @@ def handle_large_response(text, client, channel, thread_ts):
         return text, None
 
     # Uploading entire response as snippet
-    logger.info(f"Uploading full snippet: {text[:200]}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Uploading full snippet: %s", text[:200])
     file = upload_snippet(client, channel, text, "llm_response.txt", thread_ts)
     if file:
         return LONGRESPONSE, file
@@ -481,13 +610,16 @@ def handle_large_response(text, client, channel, thread_ts):
 def reconstruct_from_slackmsg(blocks):
     """Reconstruct bot message from Slack blocks for context preservation"""
     messages = []
-    logger.info(f"reconstructing from slack blocks {len(blocks)}")
+    log_info = logger.isEnabledFor(logging.INFO)
+    if log_info:
+        logger.info(f"reconstructing from slack blocks {len(blocks)}")
     for block in blocks:
         if block["type"] == "section":
             text = block["text"]["text"]
             if text.startswith(LONGRESPONSE):
                 continue
-            logger.info(f"section block: {text[:200]}")
+            if log_info:
+                logger.info(f"section block: {text[:200]}")
             messages.append(text)
                 
     return "\n".join(messages)